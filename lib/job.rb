@@ -290,6 +290,7 @@ class Job < Struct.new(:uri, :redis)
     redis.incr('jobs_failed')
     redis.lrem('pending', 0, ident)
     redis.lrem('working', 0, ident)
+    redis.scan_each(match: 'notify:*') { |key| redis.lrem(key, 0, ident) }
     redis.expire(ident, 5)
     redis.expire(log_key, 5)
     redis.expire(ignore_patterns_set_key, 5)
@@ -309,6 +310,13 @@ class Job < Struct.new(:uri, :redis)
     redis.multi do
       redis.lpush(queue, ident)
       redis.hset(ident, 'queued_at', Time.now.to_i)
+
+      # Wake a pipeline waiting on this queue (see Control#wait_for_job in
+      # the pipeline).  The notice is dropped when a pipeline claims the job
+      # or the job fails; until then it's only a hint, so keep a bounded
+      # number.
+      redis.lpush("notify:#{queue}", ident)
+      redis.ltrim("notify:#{queue}", 0, 99)
     end
   end
 
@@ -13,10 +13,17 @@ logger = logging.getLogger('archivebot.control')
 
 @contextmanager
 def conn(controller):
+    '''
+    Yields the controller's Redis client, connecting first if need be.
+
+    Callers should use the yielded client rather than controller.redis, which
+    another thread may reset to None on a connection error.
+    '''
     try:
-        if not controller.connected():
-            controller.connect()
-        yield
+        client = controller.redis
+        if client is None:
+            client = controller.connect()
+        yield client
     except RedisConnectionError as e:
         controller.disconnect()
         raise e
@@ -42,6 +49,13 @@ def candidate_queues(named_queues, pipeline_nick, ao_only, large):
 
         return matches
 
+def notice_keys(queues):
+    '''
+    Names the lists that the bot pushes a notice to whenever it queues a job
+    in one of queues.  (See Job#queue in lib/job.rb.)
+    '''
+    return ['notify:%s' % queue for queue in queues]
+
 class Control(object):
     '''
     Handles communication to and from the ArchiveBot control server.
@@ -68,6 +82,7 @@ class Control(object):
         self.countslock = threading.Lock()
 
         self.redis = self.connect()
+        self.wait_redis = None
 
         self.ending = False
         self.log_thread = threading.Thread(target=self.ship_logs)
@@ -86,13 +101,16 @@ class Control(object):
         if self.redis_url is None:
             raise RedisConnectionError('self.redis_url not set')
 
-        self.redis = redis.StrictRedis.from_url(self.redis_url,
-                                                decode_responses=True)
+        client = redis.StrictRedis.from_url(self.redis_url,
+                                            decode_responses=True)
 
-        self.register_scripts()
+        self.register_scripts(client)
+        self.redis = client
         logger.info('Redis connection successful with ident={}, thread={}'.format(
             self.ident, threading.get_ident()))
 
+        return client
+
     def disconnect(self):
         self.redis = None
 
@@ -101,55 +119,71 @@ class Control(object):
         self.disconnect()
         self.ending = True
 
-    def register_scripts(self):
-        self.mark_done_script = self.redis.register_script(MARK_DONE_SCRIPT)
-        self.mark_aborted_script = self.redis.register_script(MARK_ABORTED_SCRIPT)
-        self.log_script = self.redis.register_script(LOGGER_SCRIPT)
+    def register_scripts(self, client):
+        self.mark_done_script = client.register_script(MARK_DONE_SCRIPT)
+        self.mark_aborted_script = client.register_script(MARK_ABORTED_SCRIPT)
+        self.reserve_job_script = client.register_script(RESERVE_JOB_SCRIPT)
+        self.log_script = client.register_script(LOGGER_SCRIPT)
 
     def all_named_pending_queues(self):
-        with conn(self):
+        with conn(self) as client:
             pipelines = set()
 
-            for name in self.redis.scan_iter('pending:*'):
+            for name in client.scan_iter('pending:*'):
                 pipelines.add(name)
 
             return pipelines
 
     def reserve_job(self, pipeline_id, pipeline_nick, ao_only, large):
         named_queues = self.all_named_pending_queues()
+        queues = candidate_queues(named_queues, pipeline_nick, ao_only, large)
 
-        for queue in candidate_queues(named_queues, pipeline_nick, ao_only,
-            large):
-            ident = self.dequeue_item(queue)
+        # Checking every candidate queue and marking the job as started is
+        # done by one script, i.e. in a single round trip.
+        with conn(self) as client:
+            result = self.reserve_job_script(keys=queues,
+                                             args=[pipeline_id, time.time()],
+                                             client=client)
 
-            if ident:
-                return self.complete_reservation(ident, pipeline_id)
+        if result:
+            ident, job_data = result
+            return ident, dict(zip(job_data[::2], job_data[1::2]))
 
         return None, None
 
-    def dequeue_item(self, queue):
-        with conn(self):
-            return self.redis.rpoplpush(queue, 'working')
+    def wait_for_job(self, pipeline_nick, ao_only, large, timeout):
+        '''
+        Blocks until the bot announces a job in one of this pipeline's
+        candidate queues, or for at most timeout seconds.  Only the notice is
+        consumed; the job stays queued for reserve_job to claim.
 
-    def complete_reservation(self, ident, pipeline_id):
-        with conn(self):
-            self.redis.hmset(ident, dict(
-                started_at=time.time(),
-                pipeline_id=pipeline_id
-            ))
+        This runs on a thread of its own, so it uses its own Redis client
+        rather than the one shared with other controller calls.  It must not
+        be called from more than one thread at once.
+        '''
+        if self.wait_redis is None:
+            self.wait_redis = redis.StrictRedis.from_url(self.redis_url,
+                                                         decode_responses=True)
 
-            return ident, self.redis.hgetall(ident)
+        named_queues = set(self.wait_redis.scan_iter('pending:*'))
+        queues = candidate_queues(named_queues, pipeline_nick, ao_only, large)
 
-    def heartbeat(self, ident):
+        self.wait_redis.blpop(notice_keys(queues), timeout)
+
+    def heartbeat_many(self, idents):
         try:
-            with conn(self):
-                self.redis.hincrby(ident, 'heartbeat', 1)
+            with conn(self) as client:
+                with client.pipeline(transaction=False) as pipe:
+                    for ident in idents:
+                        pipe.hincrby(ident, 'heartbeat', 1)
+
+                    pipe.execute()
         except RedisConnectionError:
             pass
 
     def is_aborted(self, ident):
-        with conn(self):
-            return self.redis.hget(ident, 'aborted')
+        with conn(self) as client:
+            return client.hget(ident, 'aborted')
 
     def flag_logging_thread_for_termination(self):
         #TODO: alas, this results in deadlock for no apparent reason
@@ -166,15 +200,17 @@ class Control(object):
         #logger.info('Logger thread joined to thread {}'.format(threading.get_ident()))
 
     def mark_done(self, item, expire_time): # used from main controller
-        with conn(self):
+        with conn(self) as client:
             self.mark_done_script(keys=[item['ident']], args=[expire_time,
                 self.log_channel, int(time.time()), json.dumps(item['info']),
-                                                              item['log_key']])
+                                                              item['log_key']],
+                                  client=client)
 
     def mark_aborted(self, ident): # used when in wpull subprocess
         #self.flag_logging_thread_for_termination()
-        with conn(self):
-            self.mark_aborted_script(keys=[ident], args=[self.log_channel])
+        with conn(self) as client:
+            self.mark_aborted_script(keys=[ident], args=[self.log_channel],
+                                     client=client)
 
     def advise_exiting(self): # used when in wpull subprocess
         logger.info('Got exit advice with ident={}, thread={}'
@@ -195,19 +231,19 @@ class Control(object):
 
     def pipeline_report(self, pipeline_id, report):
         try:
-            with conn(self):
-                self.redis.hmset(pipeline_id, report)
-                self.redis.sadd('pipelines', pipeline_id)
-                self.redis.publish(self.pipeline_channel, pipeline_id)
+            with conn(self) as client:
+                client.hmset(pipeline_id, report)
+                client.sadd('pipelines', pipeline_id)
+                client.publish(self.pipeline_channel, pipeline_id)
         except RedisConnectionError:
             pass
 
     def unregister_pipeline(self, pipeline_id):
         try:
-            with conn(self):
-                self.redis.delete(pipeline_id)
-                self.redis.srem('pipelines', pipeline_id)
-                self.redis.publish(self.pipeline_channel, pipeline_id)
+            with conn(self) as client:
+                client.delete(pipeline_id)
+                client.srem('pipelines', pipeline_id)
+                client.publish(self.pipeline_channel, pipeline_id)
         except RedisConnectionError:
             pass
 
@@ -221,8 +257,8 @@ class Control(object):
 
         while not (self.ending and self.log_queue.empty()):
             try:
-                with conn(self):
-                    with self.redis.pipeline(transaction=False) as pipe:
+                with conn(self) as client:
+                    with client.pipeline(transaction=False) as pipe:
                         while not (self.ending and self.log_queue.empty()):
                             try:
                                 # Ship a log entry
@@ -297,14 +333,14 @@ class Control(object):
 
     def get_url_file(self, ident):
         try:
-            with conn(self):
-                return self.redis.hget(ident, 'url_file')
+            with conn(self) as client:
+                return client.hget(ident, 'url_file')
         except RedisConnectionError:
             pass
 
     def get_settings(self, ident):
-        with conn(self):
-            data = self.redis.hmget(ident, 'delay_min', 'delay_max',
+        with conn(self) as client:
+            data = client.hmget(ident, 'delay_min', 'delay_max',
                                     'concurrency',
                                     'settings_age',
                                     'abort_requested',
@@ -321,7 +357,7 @@ class Control(object):
                 )
 
             if data[6]:
-                result['ignore_patterns'] = self.redis.smembers(data[6])
+                result['ignore_patterns'] = client.smembers(data[6])
             else:
                 result['ignore_patterns'] = []
 
@@ -370,6 +406,29 @@ redis.call('hset', ident, 'aborted', 'true')
 redis.call('publish', log_channel, ident)
 '''
 
+RESERVE_JOB_SCRIPT = '''
+local pipeline_id = ARGV[1]
+local started_at = ARGV[2]
+
+-- KEYS holds the candidate queues, in the order they should be checked.
+for _, queue in ipairs(KEYS) do
+    local ident = redis.call('rpoplpush', queue, 'working')
+
+    if ident then
+        -- Pipelines that reserve without waiting never consume the job's
+        -- notice, so drop it here.
+        redis.call('lrem', 'notify:' .. queue, 0, ident)
+
+        redis.call('hmset', ident, 'started_at', started_at,
+            'pipeline_id', pipeline_id)
+
+        return {ident, redis.call('hgetall', ident)}
+    end
+end
+
+return nil
+'''
+
 LOGGER_SCRIPT = '''
 local ident = KEYS[1]
 local message = ARGV[1]
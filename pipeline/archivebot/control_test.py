@@ -1,6 +1,6 @@
 import unittest
 
-from .control import candidate_queues
+from .control import candidate_queues, conn, notice_keys
 
 class TestCandidateQueues(unittest.TestCase):
     def setUp(self):
@@ -24,3 +24,40 @@ class TestCandidateQueues(unittest.TestCase):
         queues = candidate_queues(self.named_queues, 'ovhca1-reddit-over18-55', True, large=False)
 
         self.assertEqual(set(['pending-ao']), set(queues))
+
+class TestNoticeKeys(unittest.TestCase):
+    def test_prefixes_each_queue(self):
+        keys = notice_keys(['pending:ovhca1-47', 'pending', 'pending-ao'])
+
+        self.assertEqual(['notify:pending:ovhca1-47', 'notify:pending',
+            'notify:pending-ao'], keys)
+
+class FakeController(object):
+    def __init__(self):
+        self.redis = None
+        self.connects = 0
+
+    def connect(self):
+        self.connects += 1
+        self.redis = object()
+        return self.redis
+
+    def disconnect(self):
+        self.redis = None
+
+class TestConn(unittest.TestCase):
+    def test_connects_if_disconnected(self):
+        controller = FakeController()
+
+        with conn(controller) as client:
+            self.assertIs(controller.redis, client)
+
+        self.assertEqual(1, controller.connects)
+
+    def test_client_outlives_disconnect_elsewhere(self):
+        controller = FakeController()
+
+        with conn(controller) as client:
+            controller.disconnect()
+
+            self.assertIsNotNone(client)
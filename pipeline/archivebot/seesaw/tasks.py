@@ -1,16 +1,18 @@
-import datetime
 import functools
 import glob
 import gzip
 import json
 import os
+import random
 import shutil
 import time
 import requests
 import socket
+from concurrent.futures import Future, ThreadPoolExecutor
 
 from seesaw.externalprocess import WgetDownload
 from seesaw.task import Task, SimpleTask
+from tornado import gen
 from tornado.ioloop import IOLoop
 import tornado.ioloop
 
@@ -69,37 +71,143 @@ class CheckLocalWebserver(SimpleTask):
                 raise Exception('Are you running a web server on the same machine as the pipeline? That is a big no-no!')
 
 
+def retry_on_connection_error(process):
+    '''
+    Decorates a RetryableTask's coroutine process method so that losing the
+    connection to the ArchiveBot controller schedules a retry of the item.
+    '''
+    @functools.wraps(process)
+    @gen.coroutine
+    def wrapper(self, item):
+        try:
+            yield process(self, item)
+        except ConnectionError:
+            self.notify_connection_error(item)
+            self.schedule_retry(item)
+
+    return wrapper
+
 class RetryableTask(Task):
     retry_delay = 5
+    max_retry_delay = 30
     cancelable = False
 
+    # Calls to the ArchiveBot controller block on Redis, so they are made
+    # from this thread rather than from the IOLoop.
+    executor = ThreadPoolExecutor(max_workers=1)
+
     def enqueue(self, item):
         self.start_item(item)
         item.log_output('Starting %s for %s' % (self, item.description()))
-        self.process(item)
+        self.run(item)
+
+    def run(self, item):
+        future = self.process(item)
+
+        # A coroutine process reports errors through its future; re-raise
+        # them on the IOLoop, as a plain process' errors would be.
+        if future is not None:
+            IOLoop.instance().add_future(future, lambda future: future.result())
+
+    def complete_item(self, item):
+        item.pop('retry_count', None)
+
+        super().complete_item(item)
+
+    def backoff_delay(self, item):
+        '''
+        The longest time to wait before the next retry of item.  This doubles
+        with every retry, up to max_retry_delay.
+        '''
+        return min(self.retry_delay * 2 ** item.get('retry_count', 0),
+                self.max_retry_delay)
 
     def schedule_retry(self, item):
         item.may_be_canceled = self.cancelable
 
-        IOLoop.instance().add_timeout(datetime.timedelta(seconds=self.retry_delay),
-               functools.partial(self.retry, item))
+        # Jitter keeps pipelines that all saw the same failure (or an empty
+        # queue) from retrying in lockstep.
+        max_delay = self.backoff_delay(item)
+        delay = random.uniform(max_delay / 2, max_delay)
+        item['retry_count'] = item.get('retry_count', 0) + 1
+
+        IOLoop.instance().call_later(delay, self.retry, item)
 
     def retry(self, item):
         if not item.canceled:
             item.may_be_canceled = False
 
-            self.process(item)
+            self.run(item)
 
     def notify_retry(self, reason, item):
-        item.log_output("%s. Retrying %s in %s seconds." %
-                (reason, self, self.retry_delay))
+        item.log_output("%s. Retrying %s in at most %s seconds." %
+                (reason, self, self.backoff_delay(item)))
    
     def notify_connection_error(self, item):
         self.notify_retry('Lost connection to ArchiveBot controller', item)
 
+class AsyncTask(SimpleTask):
+    '''
+    A SimpleTask whose blocking work runs on a worker thread, so that
+    filesystem calls don't stall the IOLoop.
+
+    Subclasses implement submit() rather than process().  submit() runs on
+    the IOLoop and returns a future for any work it hands to the executor,
+    or None.  Once that future resolves, the item goes through
+    SimpleTask.enqueue, whose process() re-raises any error from the future;
+    logging and completion are thus SimpleTask's own.
+
+    Work handed to the executor runs outside task_cwd(), so it should use
+    absolute paths.
+    '''
+    executor = ThreadPoolExecutor(max_workers=1)
+
+    def __init__(self, name):
+        SimpleTask.__init__(self, name)
+        self.futures = {}
+
+    def enqueue(self, item):
+        try:
+            with self.task_cwd():
+                future = self.submit(item)
+        except Exception as e:
+            future = Future()
+            future.set_exception(e)
+
+        if future is None:
+            SimpleTask.enqueue(self, item)
+        else:
+            self.futures[id(item)] = future
+            IOLoop.instance().add_future(future,
+                    lambda future: SimpleTask.enqueue(self, item))
+
+    def submit(self, item):
+        pass
+
+    def process(self, item):
+        future = self.futures.pop(id(item), None)
+
+        if future is not None:
+            future.result()
+
 # ------------------------------------------------------------------------------
 
+# The fields of a reserved job that are copied into the item.  Fields missing
+# from the job are set to None.
+JOB_KEYS = ('fetch_depth', 'log_key', 'queued_at', 'slug', 'started_by',
+            'started_in', 'url', 'url_file', 'user_agent', 'no_offsite_links',
+            'youtube_dl')
+
 class GetItemFromQueue(RetryableTask):
+    # How long one wait for a job blocks.  New named queues are only noticed
+    # between waits.
+    wait_timeout = 10
+
+    # Waiting for a job can block for wait_timeout seconds, so it gets a
+    # thread (and Redis client) of its own rather than holding up other
+    # controller calls.
+    wait_executor = ThreadPoolExecutor(max_workers=1)
+
     def __init__(self, control, pipeline_id, pipeline_nick, retry_delay=5,
         ao_only=False, large=False, version_check = None):
         RetryableTask.__init__(self, 'GetItemFromQueue')
@@ -114,6 +222,8 @@ class GetItemFromQueue(RetryableTask):
         # (versionOnStartup, versionFunc) where the latter is an argument-less function returning the current version of the files
         self.version_on_startup, self.version_func = version_check
 
+    @retry_on_connection_error
+    @gen.coroutine
     def process(self, item):
         # Check that the files haven't changed since the pipeline was launched
         currentVersion = self.version_func()
@@ -121,52 +231,79 @@ class GetItemFromQueue(RetryableTask):
             item.log_output('Version has changed from {!r} on startup to {!r} now'.format(self.version_on_startup, currentVersion))
             raise Exception('Version has changed from {!r} on startup to {!r} now'.format(self.version_on_startup, currentVersion))
 
-        try: 
-            ident, job_data = self.control.reserve_job(self.pipeline_id,
-                    self.pipeline_nick, self.ao_only, self.large)
+        ident, job_data = yield self.executor.submit(self.control.reserve_job,
+                self.pipeline_id, self.pipeline_nick, self.ao_only, self.large)
 
-            if ident == None:
-                self.schedule_retry(item)
-            else:
-                item['fetch_depth'] = job_data.get('fetch_depth')
-                item['ident'] = ident
-                item['log_key'] = job_data.get('log_key')
-                item['pipeline_id'] = self.pipeline_id
-                item['queued_at'] = job_data.get('queued_at')
-                item['slug'] = job_data.get('slug')
-                item['started_by'] = job_data.get('started_by')
-                item['started_in'] = job_data.get('started_in')
-                item['url'] = job_data.get('url')
-                item['url_file'] = job_data.get('url_file')
-                item['user_agent'] = job_data.get('user_agent')
-                item['no_offsite_links'] = job_data.get('no_offsite_links')
-                item['youtube_dl'] = job_data.get('youtube_dl')
-
-                item.log_output('Received item %s.' % ident)
-
-                self.complete_item(item)
-        except ConnectionError:
-            self.notify_connection_error(item)
-            self.schedule_retry(item)
+        if ident == None:
+            # Instead of polling again after a delay, wait for a job to show
+            # up in one of our queues and then try to reserve it.
+            item.may_be_canceled = self.cancelable
+
+            yield self.wait_executor.submit(self.control.wait_for_job,
+                    self.pipeline_nick, self.ao_only, self.large,
+                    self.wait_timeout)
+
+            self.retry(item)
+        else:
+            item.update({key: job_data.get(key) for key in JOB_KEYS})
+            item['ident'] = ident
+            item['pipeline_id'] = self.pipeline_id
+
+            item.log_output('Received item %s.' % ident)
+
+            self.complete_item(item)
 
 # ------------------------------------------------------------------------------
 
 class StartHeartbeat(SimpleTask):
     def __init__(self, control):
         SimpleTask.__init__(self, 'StartHeartbeat')
-        self.control = control
+        self.heartbeats = HeartbeatCoordinator(control)
 
     def process(self, item):
-        cb = tornado.ioloop.PeriodicCallback(
-                functools.partial(self.send_heartbeat, item),
-                1000)
+        item['heartbeat'] = self.heartbeats.add(item['ident'])
+
+class HeartbeatCoordinator(object):
+    '''
+    Sends heartbeats for every running job from a single timer, with one
+    pipelined Redis request per tick rather than one timer and request per
+    job.
+    '''
+
+    def __init__(self, control, interval=1000):
+        self.control = control
+        self.idents = set()
+        self.callback = tornado.ioloop.PeriodicCallback(self.send_heartbeats,
+                interval)
+
+    def add(self, ident):
+        self.idents.add(ident)
+
+        if not self.callback.is_running():
+            self.callback.start()
+
+        return Heartbeat(self, ident)
+
+    def remove(self, ident):
+        self.idents.discard(ident)
+
+        if not self.idents:
+            self.callback.stop()
 
-        item['heartbeat'] = cb
+    def send_heartbeats(self):
+        self.control.heartbeat_many(self.idents)
 
-        cb.start()
+class Heartbeat(object):
+    '''
+    A job's registration with a HeartbeatCoordinator.
+    '''
 
-    def send_heartbeat(self, item):
-        self.control.heartbeat(item['ident'])
+    def __init__(self, coordinator, ident):
+        self.coordinator = coordinator
+        self.ident = ident
+
+    def stop(self):
+        self.coordinator.remove(self.ident)
 
 # ------------------------------------------------------------------------------
 
@@ -187,8 +324,10 @@ class SetFetchDepth(SimpleTask):
 
 class TargetPathMixin(object):
     def set_target_paths(self, item):
-        item['target_warc_file_prefix'] = '%(data_dir)s/%(warc_file_base)s' % item
-        item['target_info_file'] = '%(data_dir)s/%(warc_file_base)s.json' % item
+        target_base = '{}/{}'.format(item['data_dir'], item['warc_file_base'])
+
+        item['target_warc_file_prefix'] = target_base
+        item['target_info_file'] = target_base + '.json'
 
     def get_source_warc_filenames(self, item):
         return list(sorted(
@@ -197,27 +336,55 @@ class TargetPathMixin(object):
 
 # ------------------------------------------------------------------------------
 
-class PreparePaths(SimpleTask, TargetPathMixin):
+class PreparePaths(AsyncTask, TargetPathMixin):
     def __init__(self):
-        SimpleTask.__init__(self, 'PreparePaths')
-
-    def process(self, item):
-        item_dir = '%(data_dir)s/%(ident)s' % item
-        last_five = item['ident'][0:5]
-
-        if os.path.isdir(item_dir):
-            shutil.rmtree(item_dir)
-        os.makedirs(item_dir)
+        AsyncTask.__init__(self, 'PreparePaths')
+        self.timestamp_second = None
+        self.timestamp = None
+
+    def current_timestamp(self):
+        '''
+        Returns the local time formatted for use in WARC names.  Items
+        prepared within the same second reuse the previous result.
+        '''
+        now = int(time.time())
+
+        if now != self.timestamp_second:
+            self.timestamp_second = now
+            self.timestamp = time.strftime("%Y%m%d-%H%M%S", time.localtime(now))
+
+        return self.timestamp
+
+    def submit(self, item):
+        ident = item['ident']
+        item_dir = '{}/{}'.format(item['data_dir'], ident)
+        warc_file_base = '{}-{}-{}'.format(item['slug'],
+                self.current_timestamp(), ident[0:5])
+        source_base = '{}/{}'.format(item_dir, warc_file_base)
 
         item['item_dir'] = item_dir
-        item['warc_file_base'] = '%s-%s-%s' % (item['slug'],
-                time.strftime("%Y%m%d-%H%M%S"), last_five)
-        item['source_warc_file_prefix'] = '%(item_dir)s/%(warc_file_base)s' % item
-        item['source_info_file'] = '%(item_dir)s/%(warc_file_base)s.json' % item
-        item['cookie_jar'] = '%(item_dir)s/cookies.txt' % item
+        item['warc_file_base'] = warc_file_base
+        item['source_warc_file_prefix'] = source_base
+        item['source_info_file'] = source_base + '.json'
+        item['cookie_jar'] = item_dir + '/cookies.txt'
 
         self.set_target_paths(item)
 
+        # Removing the leftovers of an earlier attempt at this job can mean
+        # walking thousands of files, so do it off the IOLoop.
+        return self.executor.submit(recreate_dir, item_dir)
+
+def recreate_dir(path):
+    '''
+    Creates an empty directory at path, removing anything already there.
+    '''
+    try:
+        shutil.rmtree(path)
+    except FileNotFoundError:
+        pass
+
+    os.makedirs(path)
+
 # ------------------------------------------------------------------------------
 
 class Wpull(WgetDownload):
@@ -232,21 +399,22 @@ class RelabelIfAborted(RetryableTask, TargetPathMixin):
         RetryableTask.__init__(self, 'RelabelIfAborted')
         self.control = control
 
+    @retry_on_connection_error
+    @gen.coroutine
     def process(self, item):
-        try:
-            if self.control.is_aborted(item['ident']):
-                item['aborted'] = True
-                item['warc_file_base'] = '%(warc_file_base)s-aborted' % item
+        aborted = yield self.executor.submit(self.control.is_aborted,
+                item['ident'])
 
-                self.set_target_paths(item)
+        if aborted:
+            item['aborted'] = True
+            item['warc_file_base'] = '%(warc_file_base)s-aborted' % item
 
-                item.log_output('Adjusted target WARC path to %(target_warc_file_prefix)s' %
-                        item)
+            self.set_target_paths(item)
 
-            self.complete_item(item)
-        except ConnectionError:
-            self.notify_connection_error(item)
-            self.schedule_retry(item)
+            item.log_output('Adjusted target WARC path to %(target_warc_file_prefix)s' %
+                    item)
+
+        self.complete_item(item)
 
 # ------------------------------------------------------------------------------
 
@@ -266,31 +434,31 @@ class CompressLogIfFailed(SimpleTask, TargetPathMixin):
 
 # ------------------------------------------------------------------------------
 
-class MoveFiles(SimpleTask, TargetPathMixin):
+class MoveFiles(AsyncTask, TargetPathMixin):
     def __init__(self, target_directory):
-        SimpleTask.__init__(self, "MoveFiles")
+        AsyncTask.__init__(self, "MoveFiles")
         self.target_directory = target_directory
 
-    def process(self, item):
-        item['target_warc_files'] = self.rename_warc_files(item)
+    def submit(self, item):
+        renames = self.warc_file_renames(item)
+        item['target_warc_files'] = [target for _, target in renames]
         item['all_target_files'] = item['target_warc_files'] + [item['target_info_file']]
 
         if 'target_url_file' in item:
             item['all_target_files'].append(item['target_url_file'])
-            os.rename(item['source_url_file'], item['target_url_file'])
+            renames.append((item['source_url_file'], item['target_url_file']))
 
         if 'target_log_file' in item:
             item['all_target_files'].append(item['target_log_file'])
-            os.rename(item['source_log_file'], item['target_log_file'])
+            renames.append((item['source_log_file'], item['target_log_file']))
 
-        os.rename(item['source_info_file'], item['target_info_file'])
-        shutil.rmtree("%(item_dir)s" % item)
+        renames.append((item['source_info_file'], item['target_info_file']))
 
-        for fn in item['all_target_files']:
-            shutil.move(fn, self.target_directory)
+        return self.executor.submit(move_files, renames, item['item_dir'],
+                item['all_target_files'], self.target_directory)
 
-    def rename_warc_files(self, item):
-        target_filenames = []
+    def warc_file_renames(self, item):
+        renames = []
 
         for source_filename in self.get_source_warc_filenames(item):
             assert source_filename.startswith(item['source_warc_file_prefix'])
@@ -299,13 +467,49 @@ class MoveFiles(SimpleTask, TargetPathMixin):
                 item['target_warc_file_prefix'],
                 1
             )
-            os.rename(source_filename, target_filename)
-            target_filenames.append(target_filename)
+            renames.append((source_filename, target_filename))
+
+        return renames
+
+def move_files(renames, item_dir, target_files, target_directory):
+    '''
+    Renames an item's files to their target names, removes the item
+    directory, and moves the renamed files to target_directory.
+
+    This blocks on the filesystem, so MoveFiles runs it on its executor.
+    '''
+    for source, target in renames:
+        os.replace(source, target)
 
-        return target_filenames
+    shutil.rmtree(item_dir)
+
+    for fn in target_files:
+        shutil.move(fn, target_directory)
 
 # ------------------------------------------------------------------------------
 
+# The info file's fields, in the order they are written.  This JSON object's
+# fieldset is an externally visible interface.  Adding fields is fine;
+# changing existing ones, not so much.
+INFO_FIELDS = ('aborted', 'fetch_depth', 'pipeline_id', 'queued_at',
+               'started_by', 'started_in', 'url', 'url_file')
+
+# The info file's layout: one field per line in INFO_FIELDS order, indented
+# by one space as json.dumps(info, indent=True) does, with a placeholder for
+# each field's encoded value.
+INFO_TEMPLATE = '{{\n' + ',\n'.join(
+    ' "{0}": {{{0}}}'.format(field) for field in INFO_FIELDS) + '\n}}'
+
+def encode_info(info):
+    '''
+    Encodes an info dict, which must have exactly INFO_FIELDS, to bytes.
+    Only the values go through json.dumps; the fixed layout comes from
+    INFO_TEMPLATE.  json.dumps escapes everything outside ASCII, so the
+    result is ASCII.
+    '''
+    return INFO_TEMPLATE.format(**{field: json.dumps(info[field])
+        for field in INFO_FIELDS}).encode('ascii')
+
 class WriteInfo(SimpleTask):
     def __init__(self):
         SimpleTask.__init__(self, 'WriteInfo')
@@ -319,21 +523,12 @@ class WriteInfo(SimpleTask):
         else:
             aborted = False
 
-        # This JSON object's fieldset is an externally visible interface.
-        # Adding fields is fine; changing existing ones, not so much.
-        item['info'] = {
-                'aborted': aborted,
-                'fetch_depth': item['fetch_depth'],
-                'pipeline_id': item['pipeline_id'],
-                'queued_at': item['queued_at'],
-                'started_by': item['started_by'],
-                'started_in': item['started_in'],
-                'url': item['url'],
-                'url_file': item['url_file']
-        }
-
-        with open(item['source_info_file'], 'w') as f:
-            f.write(json.dumps(item['info'], indent=True))
+        item['info'] = {field: item[field] for field in INFO_FIELDS
+                        if field != 'aborted'}
+        item['info']['aborted'] = aborted
+
+        with open(item['source_info_file'], 'wb') as f:
+            f.write(encode_info(item['info']))
 
 # ------------------------------------------------------------------------------
 
@@ -357,12 +552,14 @@ class DownloadUrlFile(RetryableTask):
                 '%(target_warc_file_prefix)s-urls.txt' % item
 
             # Files could be huge, and we do not care about their contents or
-            # encoding.  (We leave parsing the file to the crawler.)
+            # encoding.  (We leave parsing the file to the crawler.)  The size
+            # is tallied as we go, which saves a stat() afterwards.
+            size = 0
+
             with open(item['source_url_file'], 'wb') as f:
                 for chunk in r.iter_content(4096):
-                    f.write(chunk)
+                    size += f.write(chunk)
 
-            size = os.stat(item['source_url_file']).st_size
             item.log_output('Downloaded {0} bytes from {1}'.format(size, item['url_file']))
             self.complete_item(item)
         except requests.exceptions.RequestException as e:
@@ -401,12 +598,11 @@ class MarkItemAsDone(RetryableTask):
         self.control = control
         self.expire_time = expire_time
 
+    @retry_on_connection_error
+    @gen.coroutine
     def process(self, item):
-        try:
-            self.control.mark_done(item, self.expire_time)
-            self.complete_item(item)
-        except ConnectionError:
-            self.notify_connection_error(item)
-            self.schedule_retry(item)
+        yield self.executor.submit(self.control.mark_done, item,
+                self.expire_time)
+        self.complete_item(item)
 
 # vim:ts=4:sw=4:et:tw=78
@@ -0,0 +1,205 @@
+import json
+import os
+import tempfile
+import unittest
+
+from concurrent.futures import Future
+from redis.exceptions import ConnectionError
+from seesaw.item import Item
+from tornado import gen
+from tornado.ioloop import IOLoop
+
+from .tasks import AsyncTask, HeartbeatCoordinator, RetryableTask, \
+    WriteInfo, encode_info, retry_on_connection_error
+
+class DisconnectedTask(RetryableTask):
+    def __init__(self):
+        RetryableTask.__init__(self, 'Disconnected')
+        self.retried = []
+
+    @retry_on_connection_error
+    @gen.coroutine
+    def process(self, item):
+        raise ConnectionError()
+
+    def notify_connection_error(self, item):
+        pass
+
+    def schedule_retry(self, item):
+        self.retried.append(item)
+
+class TestRetryableTask(unittest.TestCase):
+    def setUp(self):
+        self.task = RetryableTask('Test')
+        self.item = {}
+
+    def test_first_retry_uses_retry_delay(self):
+        self.assertEqual(5, self.task.backoff_delay(self.item))
+
+    def test_backoff_doubles_with_each_retry(self):
+        self.item['retry_count'] = 2
+
+        self.assertEqual(20, self.task.backoff_delay(self.item))
+
+    def test_backoff_is_capped(self):
+        self.item['retry_count'] = 10
+
+        self.assertEqual(self.task.max_retry_delay,
+                self.task.backoff_delay(self.item))
+
+class TestRetryOnConnectionError(unittest.TestCase):
+    def test_connection_error_schedules_retry(self):
+        task = DisconnectedTask()
+        item = {}
+
+        task.process(item)
+
+        self.assertEqual([item], task.retried)
+
+class FakeControl(object):
+    def __init__(self):
+        self.heartbeats = []
+
+    def heartbeat_many(self, idents):
+        self.heartbeats.append(set(idents))
+
+class TestHeartbeatCoordinator(unittest.TestCase):
+    def setUp(self):
+        self.control = FakeControl()
+        self.coordinator = HeartbeatCoordinator(self.control)
+
+    def tearDown(self):
+        self.coordinator.callback.stop()
+
+    def test_starts_on_first_add(self):
+        self.assertFalse(self.coordinator.callback.is_running())
+
+        self.coordinator.add('job1')
+
+        self.assertTrue(self.coordinator.callback.is_running())
+
+    def test_stops_when_last_heartbeat_stops(self):
+        heartbeat1 = self.coordinator.add('job1')
+        heartbeat2 = self.coordinator.add('job2')
+
+        heartbeat1.stop()
+        self.assertTrue(self.coordinator.callback.is_running())
+
+        heartbeat2.stop()
+        self.assertFalse(self.coordinator.callback.is_running())
+
+    def test_restarts_on_later_add(self):
+        self.coordinator.add('job1').stop()
+
+        self.coordinator.add('job2')
+
+        self.assertTrue(self.coordinator.callback.is_running())
+
+    def test_sends_one_heartbeat_for_all_jobs(self):
+        self.coordinator.add('job1')
+        self.coordinator.add('job2')
+
+        self.coordinator.send_heartbeats()
+
+        self.assertEqual([set(['job1', 'job2'])], self.control.heartbeats)
+
+class FakeAsyncTask(AsyncTask):
+    def __init__(self, submit):
+        AsyncTask.__init__(self, 'FakeAsync')
+        self.submit = submit
+
+class TestAsyncTask(unittest.TestCase):
+    def setUp(self):
+        self.item = Item(None, 'test', 1, prepare_data_directory=False)
+
+    def run_task(self, task):
+        results = []
+        task.on_complete_item += lambda task, item: results.append('completed')
+        task.on_fail_item += lambda task, item: results.append('failed')
+
+        loop = IOLoop.instance()
+        task.on_finish_item += lambda task, item: loop.stop()
+        timeout = loop.call_later(5, loop.stop)
+        loop.add_callback(task.enqueue, self.item)
+        loop.start()
+        loop.remove_timeout(timeout)
+
+        return results
+
+    def failed_future(self):
+        future = Future()
+        future.set_exception(OSError())
+        return future
+
+    def test_completes_if_nothing_is_submitted(self):
+        task = FakeAsyncTask(lambda item: None)
+
+        self.assertEqual(['completed'], self.run_task(task))
+
+    def test_completes_once_future_resolves(self):
+        task = FakeAsyncTask(lambda item: AsyncTask.executor.submit(int))
+
+        self.assertEqual(['completed'], self.run_task(task))
+
+    def test_fails_if_submit_raises(self):
+        def submit(item):
+            raise OSError()
+
+        task = FakeAsyncTask(submit)
+
+        self.assertEqual(['failed'], self.run_task(task))
+
+    def test_fails_if_future_raises(self):
+        task = FakeAsyncTask(lambda item: self.failed_future())
+
+        self.assertEqual(['failed'], self.run_task(task))
+        self.assertEqual({}, task.futures)
+
+class TestWriteInfo(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.item = {
+            'fetch_depth': 'inf',
+            'pipeline_id': 'pipeline:abc123',
+            'queued_at': '1500000000',
+            'source_info_file': os.path.join(self.temp_dir.name, 'info.json'),
+            'started_by': 'someone',
+            'started_in': '#archivebot',
+            'url': 'http://www.example.com/\u00e9"\\',
+            'url_file': None
+        }
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_writes_every_info_field(self):
+        WriteInfo().process(self.item)
+
+        with open(self.item['source_info_file']) as f:
+            self.assertEqual(self.item['info'], json.load(f))
+
+    def test_encoding_layout(self):
+        info = {
+            'aborted': False,
+            'fetch_depth': 'inf',
+            'pipeline_id': 'pipeline:abc123',
+            'queued_at': '1500000000',
+            'started_by': 'someone',
+            'started_in': '#archivebot',
+            'url': 'http://www.example.com/\u00e9"\\',
+            'url_file': None
+        }
+
+        encoded = encode_info(info)
+
+        self.assertEqual(info, json.loads(encoded.decode('ascii')))
+        self.assertEqual(b'{\n'
+                b' "aborted": false,\n'
+                b' "fetch_depth": "inf",\n'
+                b' "pipeline_id": "pipeline:abc123",\n'
+                b' "queued_at": "1500000000",\n'
+                b' "started_by": "someone",\n'
+                b' "started_in": "#archivebot",\n'
+                b' "url": "http://www.example.com/\\u00e9\\"\\\\",\n'
+                b' "url_file": null\n'
+                b'}', encoded)